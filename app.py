@@ -1,12 +1,16 @@
 from __future__ import annotations
-import os, io, secrets, urllib.parse
-from datetime import datetime
-from functools import wraps
+import os, io, hashlib, secrets, urllib.parse
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
+from textwrap import wrap
 from typing import Optional
 from werkzeug.utils import secure_filename
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, g, make_response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload, contains_eager, load_only
 
 
 from flask_login import (
@@ -20,13 +24,29 @@ from flask_login import (
 from werkzeug.security import generate_password_hash, check_password_hash
 from reportlab.lib.pagesizes import A5, landscape
 from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen import canvas
 import qrcode
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DB_PATH = os.path.join(BASE_DIR, "sat.db")
 UPLOAD_DIR = os.path.join(BASE_DIR, "static", "uploads")
+QR_DIR = os.path.join(BASE_DIR, "static", "qr")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(QR_DIR, exist_ok=True)
+
+# Tamaño de página del PDF de la orden (A5 apaisado)
+PDF_PAGESIZE = landscape(A5)
+
+# Posiciones del PDF en puntos, calculadas una sola vez
+PDF_WIDTH, PDF_HEIGHT = PDF_PAGESIZE
+PDF_MARGIN = 10 * mm
+PDF_HEADER_X = 45 * mm  # texto de cabecera, a la derecha del logo
+PDF_LOGO_W, PDF_LOGO_H = 30 * mm, 20 * mm
+PDF_QR_X = PDF_WIDTH - 60 * mm
+PDF_QR_SIZE = 40 * mm
+# Coordenada Y para "n mm desde el borde superior"
+PDF_Y = {n: PDF_HEIGHT - n * mm for n in (15, 21, 25, 32, 38, 48, 54, 64, 70, 80, 82, 84, 88, 102, 108, 120, 126)}
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY", "dev-secret")
@@ -44,6 +64,13 @@ if database_url:
         database_url = database_url.replace("postgres://", "postgresql://", 1)
 
     app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    # Pool de conexiones: reutiliza las conexiones TLS y descarta las que Render cerró
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
 else:
     # Local → SQLite
     app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_PATH}"
@@ -51,6 +78,8 @@ else:
 # No cambiar
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["MAX_CONTENT_LENGTH"] = 4 * 1024 * 1024
+# Logos (nombre aleatorio por subida) y QR (token fijo) no cambian: cache largo en el navegador/CDN
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 31536000
 
 db = SQLAlchemy(app)
 
@@ -68,6 +97,16 @@ ORDER_STATES = [
     ("entregado", "Entregado"),
     ("cancelado", "Cancelado"),
 ]
+ORDER_STATES_DICT = dict(ORDER_STATES)
+
+# Filas por página en los listados
+PER_PAGE = 50
+
+# Estados que cuentan como "abiertas" en el dashboard
+OPEN_STATES = ["recibido", "diagnostico", "en_proceso", "esperando_repuestos"]
+
+# KDF fijo para que el costo por login no dependa de la versión de Werkzeug
+PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
 
 ROLE_CHOICES = [
     ("admin", "Administrador"),
@@ -75,9 +114,21 @@ ROLE_CHOICES = [
     ("cajero", "Cajero"),
 ]
 
+# Formato de moneda argentino: miles con punto y decimales con coma
+_ARS_TRANS = str.maketrans({",": ".", ".": ","})
+
+def ars(x: float) -> str:
+    return f"AR$ {x:,.2f}".translate(_ARS_TRANS)
+
+def utcnow() -> datetime:
+    # UTC sin tzinfo, igual que guardan las columnas DateTime (reemplaza datetime.utcnow, deprecado)
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+# 32 símbolos (sin 0/O/1/I): cada byte aleatorio aporta 5 bits sin sesgo
+TOKEN_ALPHABET = b"ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+
 def gen_token(n=10):
-    alphabet = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
-    return "".join(secrets.choice(alphabet) for _ in range(n))
+    return bytes(TOKEN_ALPHABET[x & 31] for x in secrets.token_bytes(n)).decode()
 
 class Settings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -95,13 +146,24 @@ class Client(db.Model):
     telefono = db.Column(db.String(50))
     email = db.Column(db.String(120))
     direccion = db.Column(db.String(200))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=utcnow)
     dni = db.Column(db.String(20), nullable=True)
 
+    # Índices trigram para nombre/DNI en el buscador de órdenes (solo Postgres, requiere pg_trgm)
+    __table_args__ = tuple(
+        db.Index(
+            f"ix_client_{col}_trgm",
+            col,
+            postgresql_using="gin",
+            postgresql_ops={col: "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql")
+        for col in ("nombre", "dni")
+    )
+
 
 class RepairOrder(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    client_id = db.Column(db.Integer, db.ForeignKey("client.id"), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey("client.id"), nullable=False, index=True)
     client = db.relationship("Client", backref=db.backref("orders", lazy=True))
 
     marca = db.Column(db.String(80), nullable=False)
@@ -116,38 +178,70 @@ class RepairOrder(db.Model):
     senia = db.Column(db.Float, default=0.0)
 
     estado = db.Column(db.String(40), default="recibido", nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)
 
     token_publico = db.Column(db.String(16), unique=True, default=lambda: gen_token(10))
 
+    # Filtro por estado + orden por fecha (listado y dashboard)
+    __table_args__ = (db.Index("ix_order_estado_created", "estado", "created_at"),)
+
     def estado_label(self):
-        return dict(ORDER_STATES).get(self.estado, self.estado)
+        return ORDER_STATES_DICT.get(self.estado, self.estado)
 
 class StatusHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey("repair_order.id"), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey("repair_order.id"), nullable=False, index=True)
     order = db.relationship("RepairOrder", backref=db.backref("historial", lazy=True, order_by="StatusHistory.created_at.desc()"))
     estado = db.Column(db.String(40), nullable=False)
     nota = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=utcnow)
 
 class Part(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey("repair_order.id"), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey("repair_order.id"), nullable=False, index=True)
     order = db.relationship("RepairOrder", backref=db.backref("repuestos", lazy=True))
     descripcion = db.Column(db.String(200), nullable=False)
     costo = db.Column(db.Float, nullable=False, default=0.0)
 
 class CashEntry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    fecha = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    tipo = db.Column(db.String(10), nullable=False)  # entrada/salida
+    fecha = db.Column(db.DateTime, default=utcnow, nullable=False, index=True)
+    tipo = db.Column(db.String(10), nullable=False, index=True)  # entrada/salida
     concepto = db.Column(db.String(200), nullable=False)
     monto = db.Column(db.Float, nullable=False)
-    order_id = db.Column(db.Integer, db.ForeignKey("repair_order.id"))
+    order_id = db.Column(db.Integer, db.ForeignKey("repair_order.id"), index=True)
     order = db.relationship("RepairOrder", backref=db.backref("movimientos_caja", lazy=True))
 
+# ============================
+#   BÚSQUEDA
+# ============================
+def _search_text(*cols):
+    # Concatena las columnas para buscar con un único ILIKE. Los literales se renderizan
+    # en línea para que la expresión coincida con la del índice en Postgres.
+    empty = db.literal("", db.String, literal_execute=True)
+    sep = db.literal(" ", db.String, literal_execute=True)
+    expr = db.func.coalesce(cols[0], empty)
+    for col in cols[1:]:
+        expr = expr + sep + db.func.coalesce(col, empty)
+    return expr
+
+CLIENT_SEARCH = _search_text(Client.nombre, Client.telefono, Client.email, Client.direccion, Client.dni)
+ORDER_SEARCH = _search_text(RepairOrder.imei, RepairOrder.marca, RepairOrder.modelo)
+
+db.Index(
+    "ix_client_search_trgm",
+    CLIENT_SEARCH.label("client_search"),
+    postgresql_using="gin",
+    postgresql_ops={"client_search": "gin_trgm_ops"},
+).ddl_if(dialect="postgresql")
+db.Index(
+    "ix_order_search_trgm",
+    ORDER_SEARCH.label("order_search"),
+    postgresql_using="gin",
+    postgresql_ops={"order_search": "gin_trgm_ops"},
+).ddl_if(dialect="postgresql")
+
 # ============================
 #   USUARIOS PARA LOGIN
 # ============================
@@ -158,7 +252,7 @@ class User(db.Model, UserMixin):
     role = db.Column(db.String(20), default="tecnico")  # admin / tecnico / cajero
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -166,7 +260,7 @@ class User(db.Model, UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 def parse_float(val: Optional[str]) -> Optional[float]:
     if val is None or val.strip() == "":
@@ -176,16 +270,29 @@ def parse_float(val: Optional[str]) -> Optional[float]:
     except ValueError:
         return None
 
+def cash_totals() -> tuple[float, float]:
+    # Entradas y salidas de caja en una sola consulta
+    entradas, salidas = db.session.query(
+        db.func.coalesce(db.func.sum(case((CashEntry.tipo == "entrada", CashEntry.monto), else_=0.0)), 0.0),
+        db.func.coalesce(db.func.sum(case((CashEntry.tipo == "salida", CashEntry.monto), else_=0.0)), 0.0),
+    ).one()
+    return entradas or 0.0, salidas or 0.0
+
 def get_settings() -> Settings:
+    # Una sola consulta por request: se guarda en flask.g
+    s = g.get("_settings")
+    if s is not None:
+        return s
     try:
-        s = Settings.query.get(1)
+        s = db.session.get(Settings, 1)
         if not s:
             s = Settings(id=1)
             db.session.add(s)
             db.session.commit()
-        return s
     except Exception:
-        return Settings(id=1)
+        s = Settings(id=1)
+    g._settings = s
+    return s
 
 
 def roles_required(*roles):
@@ -214,10 +321,9 @@ def seed():
     s = get_settings()
     if not Client.query.first():
         c1 = Client(nombre="Juan Pérez", telefono="261-555-1234", email="juan@example.com", direccion="San Martín 123")
-        db.session.add(c1); db.session.commit()
         o1 = RepairOrder(client=c1, marca="Samsung", modelo="A54", imei="3598...", accesorios="Funda", clave_desbloqueo="1-2-5-8",
                          problema_reportado="No carga", diagnostico="Conector", costo_estimado=45000, senia=10000, estado="diagnostico")
-        db.session.add(o1); db.session.commit()
+        db.session.add_all([c1, o1]); db.session.flush()
         db.session.add(StatusHistory(order=o1, estado="recibido", nota="Ingreso"))
         db.session.add(StatusHistory(order=o1, estado="diagnostico", nota="Se detecta conector"))
         db.session.add(Part(order=o1, descripcion="Conector USB-C", costo=12000.0))
@@ -225,6 +331,24 @@ def seed():
         db.session.commit()
         print("DB demo creada.")
 
+# pg_trgm tiene que existir antes de crear los índices trigram de Client
+db.event.listen(
+    Client.__table__,
+    "before_create",
+    db.DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+
+@app.cli.command("create-indexes")
+def create_indexes():
+    # create_all no agrega índices a tablas existentes: los creamos uno por uno
+    if db.engine.dialect.name == "postgresql":
+        with db.engine.begin() as conn:
+            conn.execute(db.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    print("Índices verificados/creados.")
+
 @app.context_processor
 def inject_settings():
     # Obtenemos la configuración principal
@@ -233,9 +357,13 @@ def inject_settings():
     # La exponemos con las dos claves:
     # - 'settings'  (por si algún template viejo la usa)
     # - 'app_settings' (para base.html y otros nuevos)
+    # Además, la URL del logo ya resuelta y las etiquetas de estado
+    logo_url = url_for("static", filename=f"uploads/{settings.logo_filename}") if settings.logo_filename else None
     return {
         "settings": settings,
         "app_settings": settings,
+        "logo_url": logo_url,
+        "order_states": ORDER_STATES_DICT,
     }
 
 
@@ -250,26 +378,47 @@ def create_default_admin():
         admin = User(username="admin", role="admin")
         admin.set_password("admin") 
         db.session.add(admin)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Otro worker lo creó al mismo tiempo (INIT_DB_ON_STARTUP con varios workers)
+            db.session.rollback()
+            return
         print(">>> Usuario Admin creado por defecto (User: admin / Pass: admin)")
 
 # --- FIN DEL CAMBIO ---
 
+# Inicialización única al arrancar (no por request). Activar con INIT_DB_ON_STARTUP=1
+if os.getenv("INIT_DB_ON_STARTUP") == "1":
+    with app.app_context():
+        db.create_all()
+        create_default_admin()
 
 
 @app.get("/")
 @login_required
 def index():
-    total_orders = RepairOrder.query.count()
-    open_orders = RepairOrder.query.filter(RepairOrder.estado.in_(["recibido","diagnostico","en_proceso","esperando_repuestos"])).count()
-    ready_orders = RepairOrder.query.filter_by(estado="listo").count()
-    delivered_orders = RepairOrder.query.filter_by(estado="entregado").count()
-    recent = RepairOrder.query.order_by(RepairOrder.created_at.desc()).limit(8).all()
-    entradas = db.session.query(db.func.coalesce(db.func.sum(CashEntry.monto),0.0)).filter(CashEntry.tipo=="entrada").scalar() or 0.0
-    salidas = db.session.query(db.func.coalesce(db.func.sum(CashEntry.monto),0.0)).filter(CashEntry.tipo=="salida").scalar() or 0.0
+    # Todos los contadores del dashboard en una sola consulta
+    counts = db.session.query(
+        db.func.count(RepairOrder.id).label("total"),
+        db.func.coalesce(db.func.sum(case((RepairOrder.estado.in_(OPEN_STATES), 1), else_=0)), 0).label("open"),
+        db.func.coalesce(db.func.sum(case((RepairOrder.estado == "listo", 1), else_=0)), 0).label("ready"),
+        db.func.coalesce(db.func.sum(case((RepairOrder.estado == "entregado", 1), else_=0)), 0).label("delivered"),
+    ).one()
+    # Solo las columnas que muestra el dashboard (sin los textos largos)
+    recent = (
+        RepairOrder.query.options(
+            load_only(RepairOrder.id, RepairOrder.marca, RepairOrder.modelo, RepairOrder.estado, RepairOrder.created_at),
+            joinedload(RepairOrder.client).load_only(Client.nombre),
+        )
+        .order_by(RepairOrder.created_at.desc())
+        .limit(8)
+        .all()
+    )
+    entradas, salidas = cash_totals()
     saldo = entradas - salidas
-    return render_template("index.html", total_orders=total_orders, open_orders=open_orders,
-                           ready_orders=ready_orders, delivered_orders=delivered_orders, recent=recent, saldo=saldo)
+    return render_template("index.html", total_orders=counts.total, open_orders=counts.open,
+                           ready_orders=counts.ready, delivered_orders=counts.delivered, recent=recent, saldo=saldo)
 
 # Settings
 @app.get("/settings")
@@ -382,7 +531,7 @@ def user_create():
 @login_required
 @role_required("admin")
 def user_edit_form(user_id: int):
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     return render_template("user_form.html", user=user, role_choices=ROLE_CHOICES)
 
 
@@ -390,7 +539,7 @@ def user_edit_form(user_id: int):
 @login_required
 @role_required("admin")
 def user_update(user_id: int):
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
 
     username = request.form.get("username", "").strip()
     password = request.form.get("password", "").strip()
@@ -423,7 +572,7 @@ def user_update(user_id: int):
 @login_required
 @role_required("admin")
 def user_delete(user_id: int):
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
 
     if user.id == current_user.id:
         flash("No podés eliminar tu propio usuario.", "danger")
@@ -452,9 +601,11 @@ def clients_list():
     query = Client.query
     if q:
         like = f"%{q}%"
-        query = query.filter(or_(Client.nombre.ilike(like), Client.telefono.ilike(like), Client.email.ilike(like), Client.direccion.ilike(like), Client.dni.ilike(like)))
-    clients = query.order_by(Client.created_at.desc()).all()
-    return render_template("clients_list.html", clients=clients, q=q)
+        query = query.filter(CLIENT_SEARCH.ilike(like))
+    page = request.args.get("page", 1, type=int)
+    # id desempata filas con el mismo created_at (si no, se repiten o saltean entre páginas)
+    pagination = query.order_by(Client.created_at.desc(), Client.id.desc()).paginate(page=page, per_page=PER_PAGE, error_out=False)
+    return render_template("clients_list.html", clients=pagination.items, pagination=pagination, q=q)
 
 @app.get("/clients/new")
 @login_required
@@ -499,7 +650,7 @@ def client_create():
 @roles_required("admin", "tecnico", "cajero")
 
 def client_edit_form(client_id: int):
-    client = Client.query.get_or_404(client_id)
+    client = db.get_or_404(Client, client_id)
     return render_template("client_form.html", client=client)
 
 @app.post("/clients/<int:client_id>/edit")
@@ -507,7 +658,7 @@ def client_edit_form(client_id: int):
 @roles_required("admin", "tecnico", "cajero")
 
 def client_update(client_id: int):
-    client = Client.query.get_or_404(client_id)
+    client = db.get_or_404(Client, client_id)
 
     nombre = request.form.get("nombre", "").strip()
     telefono = request.form.get("telefono", "").strip()
@@ -541,16 +692,22 @@ def client_update(client_id: int):
 def orders_list():
     q = request.args.get("q","").strip()
     estado = request.args.get("estado","").strip()
-    query = RepairOrder.query.join(Client)
+    # contains_eager reutiliza el JOIN para cargar el cliente (evita N+1 en el template)
+    query = RepairOrder.query.join(Client).options(contains_eager(RepairOrder.client))
     if q:
         like = f"%{q}%"
-        query = query.filter(or_(RepairOrder.id.like(f"%{q}%"), RepairOrder.imei.ilike(like),
-                                 RepairOrder.marca.ilike(like), RepairOrder.modelo.ilike(like),
-                                 Client.nombre.ilike(like), Client.dni.ilike(like) ))
+        conds = [ORDER_SEARCH.ilike(like), Client.nombre.ilike(like), Client.dni.ilike(like)]
+        # El número de orden va por igualdad (usa la PK): un LIKE sobre el id obligaría
+        # a recorrer toda la tabla y dejaría sin uso los índices trigram del OR
+        if q.isdigit():
+            conds.append(RepairOrder.id == int(q))
+        query = query.filter(or_(*conds))
     if estado:
         query = query.filter(RepairOrder.estado==estado)
-    orders = query.order_by(RepairOrder.created_at.desc()).all()
-    return render_template("orders_list.html", orders=orders, q=q, estado=estado, estados=ORDER_STATES)
+    page = request.args.get("page", 1, type=int)
+    # id desempata filas con el mismo created_at (si no, se repiten o saltean entre páginas)
+    pagination = query.order_by(RepairOrder.created_at.desc(), RepairOrder.id.desc()).paginate(page=page, per_page=PER_PAGE, error_out=False)
+    return render_template("orders_list.html", orders=pagination.items, pagination=pagination, q=q, estado=estado, estados=ORDER_STATES)
 
 @app.get("/orders/new")
 @login_required
@@ -565,8 +722,8 @@ def order_new_form():
 @roles_required("admin", "tecnico", "cajero")
 
 def order_create():
-    client_id = request.form.get("client_id")
-    client = Client.query.get(client_id)
+    client_id = request.form.get("client_id", type=int)
+    client = db.session.get(Client, client_id) if client_id else None
     if not client:
         flash("Debe seleccionar un cliente válido.", "danger")
         return redirect(url_for("order_new_form"))
@@ -589,12 +746,12 @@ def order_create():
         senia=parse_float(request.form.get("senia")) or 0.0,
         estado=request.form.get("estado","recibido"),
     )
-    db.session.add(order); db.session.commit()
+    db.session.add(order)
+    db.session.flush()  # asigna order.id sin commitear (se usa en el concepto de caja)
     db.session.add(StatusHistory(order=order, estado=order.estado, nota="Ingreso de la orden"))
-    db.session.commit()
     if order.senia and order.senia>0:
         db.session.add(CashEntry(tipo="entrada", concepto=f"Seña orden #{order.id}", monto=order.senia, order=order))
-        db.session.commit()
+    db.session.commit()
     flash(f"Orden #{order.id} creada.", "success")
     return redirect(url_for("orders_list"))
 
@@ -603,19 +760,28 @@ def order_create():
 @roles_required("admin", "tecnico", "cajero")
 
 def order_detail(order_id: int):
-    order = RepairOrder.query.get_or_404(order_id)
+    order = (
+        RepairOrder.query.options(
+            joinedload(RepairOrder.client),
+            selectinload(RepairOrder.repuestos),
+            selectinload(RepairOrder.historial),
+        )
+        .filter_by(id=order_id)
+        .first_or_404()
+    )
     public_url = url_for("order_public", token=order.token_publico, _external=True)
     text = f"Hola {order.client.nombre}, te compartimos el estado de tu orden #{order.id}: {public_url}"
     wa_link = "https://wa.me/?text=" + urllib.parse.quote(text)
     total_repuestos = sum([(p.costo or 0.0) for p in order.repuestos])
-    return render_template("order_detail.html", order=order, estados=ORDER_STATES, public_url=public_url, wa_link=wa_link, total_repuestos=total_repuestos)
+    qr_url = _qr_static_url(order.token_publico, public_url)
+    return render_template("order_detail.html", order=order, estados=ORDER_STATES, public_url=public_url, wa_link=wa_link, total_repuestos=total_repuestos, qr_url=qr_url)
 
 @app.get("/orders/<int:order_id>/edit")
 @login_required
 @roles_required("admin", "tecnico", "cajero")
 
 def order_edit_form(order_id: int):
-    order = RepairOrder.query.get_or_404(order_id)
+    order = db.get_or_404(RepairOrder, order_id)
     clients = Client.query.order_by(Client.nombre.asc()).all()
     return render_template("order_form.html", order=order, clients=clients, estados=ORDER_STATES)
 
@@ -624,9 +790,9 @@ def order_edit_form(order_id: int):
 @roles_required("admin", "tecnico", "cajero")
 
 def order_update(order_id: int):
-    order = RepairOrder.query.get_or_404(order_id)
-    client_id = request.form.get("client_id")
-    client = Client.query.get(client_id)
+    order = db.get_or_404(RepairOrder, order_id)
+    client_id = request.form.get("client_id", type=int)
+    client = db.session.get(Client, client_id) if client_id else None
     if not client:
         flash("Cliente inválido.", "danger")
         return redirect(url_for("order_edit_form", order_id=order.id))
@@ -649,11 +815,11 @@ def order_update(order_id: int):
 @roles_required("admin", "tecnico", "cajero")
 
 def order_change_status(order_id: int):
-    order = RepairOrder.query.get_or_404(order_id)
+    order = db.get_or_404(RepairOrder, order_id)
     nuevo_estado = request.form.get("estado")
     nota = request.form.get("nota", "").strip()
 
-    if nuevo_estado not in dict(ORDER_STATES):
+    if nuevo_estado not in ORDER_STATES_DICT:
         flash("Estado inválido.", "danger")
         return redirect(url_for("order_detail", order_id=order.id))
 
@@ -668,10 +834,10 @@ def order_change_status(order_id: int):
     # 1) Si se entrega el equipo, registramos el cobro restante en caja
     if nuevo_estado == "entregado" and order.costo_estimado and order.costo_estimado > 0:
         # Total ya cobrado (por seña u otros pagos ligados a la orden)
-        total_pagado = sum(
-            (mov.monto or 0.0)
-            for mov in order.movimientos_caja
-            if mov.tipo == "entrada"
+        total_pagado = (
+            db.session.query(db.func.coalesce(db.func.sum(CashEntry.monto), 0.0))
+            .filter(CashEntry.order_id == order.id, CashEntry.tipo == "entrada")
+            .scalar()
         )
 
         restante = round(order.costo_estimado - total_pagado, 2)
@@ -691,10 +857,14 @@ def order_change_status(order_id: int):
     # 2) Si se cancela la orden, devolvemos la seña en caja (salida)
     elif nuevo_estado == "cancelado" and order.senia and order.senia > 0:
         # Total ya devuelto previamente (por si se cambió varias veces de estado)
-        total_devuelto = sum(
-            (mov.monto or 0.0)
-            for mov in order.movimientos_caja
-            if mov.tipo == "salida" and (mov.concepto or "").startswith("Devolución seña")
+        total_devuelto = (
+            db.session.query(db.func.coalesce(db.func.sum(CashEntry.monto), 0.0))
+            .filter(
+                CashEntry.order_id == order.id,
+                CashEntry.tipo == "salida",
+                CashEntry.concepto.like("Devolución seña%"),
+            )
+            .scalar()
         )
 
         a_devolver = round(order.senia - total_devuelto, 2)
@@ -721,7 +891,7 @@ def order_change_status(order_id: int):
 @roles_required("admin", "tecnico")
 
 def add_part(order_id: int):
-    order = RepairOrder.query.get_or_404(order_id)
+    order = db.get_or_404(RepairOrder, order_id)
     desc = request.form.get("descripcion","").strip()
     costo = parse_float(request.form.get("costo")) or 0.0
     if not desc:
@@ -736,7 +906,7 @@ def add_part(order_id: int):
 @roles_required("admin", "tecnico")
 
 def del_part(order_id: int, part_id: int):
-    part = Part.query.get_or_404(part_id)
+    part = db.get_or_404(Part, part_id)
     db.session.delete(part); db.session.commit()
     flash("Repuesto eliminado.", "success")
     return redirect(url_for("order_detail", order_id=order_id))
@@ -747,8 +917,7 @@ def del_part(order_id: int, part_id: int):
 @roles_required("admin", "cajero")
 
 def cash_list():
-    entradas = db.session.query(db.func.coalesce(db.func.sum(CashEntry.monto),0.0)).filter(CashEntry.tipo=="entrada").scalar() or 0.0
-    salidas = db.session.query(db.func.coalesce(db.func.sum(CashEntry.monto),0.0)).filter(CashEntry.tipo=="salida").scalar() or 0.0
+    entradas, salidas = cash_totals()
     saldo = entradas - salidas
     rows = CashEntry.query.order_by(CashEntry.fecha.desc()).limit(200).all()
     return render_template("cash_list.html", rows=rows, entradas=entradas, salidas=salidas, saldo=saldo)
@@ -769,47 +938,65 @@ def cash_create():
     tipo = request.form.get("tipo")
     concepto = request.form.get("concepto","").strip()
     monto = parse_float(request.form.get("monto")) or 0.0
-    order_id = request.form.get("order_id")
+    order_id = request.form.get("order_id", type=int)
     if tipo not in ("entrada","salida") or not concepto or monto<=0:
         flash("Completar tipo, concepto y monto (>0).", "danger")
         return redirect(url_for("cash_new_form"))
-    entry = CashEntry(tipo=tipo, concepto=concepto, monto=monto, order=RepairOrder.query.get(order_id) if order_id else None)
+    entry = CashEntry(tipo=tipo, concepto=concepto, monto=monto, order=db.session.get(RepairOrder, order_id) if order_id else None)
     db.session.add(entry); db.session.commit()
     flash("Movimiento registrado.", "success")
     return redirect(url_for("cash_list"))
 
 # PDF
+@lru_cache(maxsize=512)
 def _qr_bytes_for_url(url: str) -> bytes:
-    img = qrcode.make(url)
+    # El QR de una orden nunca cambia: se genera una vez por URL y queda en memoria
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=4, border=2)
+    qr.add_data(url)
+    qr.make(fit=True)
+    img = qr.make_image()
     buf = io.BytesIO()
     img.save(buf, format="PNG")
     return buf.getvalue()
 
+@lru_cache(maxsize=8)
+def _wrap_condiciones(texto: str) -> tuple[str, ...]:
+    # Las condiciones casi nunca cambian: el texto mismo es la clave, no hace falta invalidar
+    lineas = wrap(texto.replace("\r", "").strip(), 110)  # ajustá el 110 si querés más/menos ancho
+    # Máximo de líneas visibles para no pisar el resto del contenido
+    return tuple(lineas[:6])
+
+@lru_cache(maxsize=4)
+def _load_logo(path: str, mtime: float) -> ImageReader:
+    # mtime forma parte de la clave: si el archivo cambia se vuelve a leer
+    return ImageReader(path)
+
+def _logo_reader(filename: str) -> ImageReader:
+    path = os.path.join(UPLOAD_DIR, filename)
+    return _load_logo(path, os.path.getmtime(path))
+
 @app.get("/orders/<int:order_id>/pdf")
 @login_required
 @roles_required("admin", "tecnico", "cajero")
 
 def order_pdf(order_id: int):
-    o = RepairOrder.query.get_or_404(order_id)
+    o = db.get_or_404(RepairOrder, order_id)
     s = get_settings()
     public_url = url_for("order_public", token=o.token_publico, _external=True)
     qr_png = _qr_bytes_for_url(public_url)
 
     buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=landscape(A5))
-    width, height = landscape(A5)
+    c = canvas.Canvas(buffer, pagesize=PDF_PAGESIZE)
 
     # Logo
     if s.logo_filename:
-        from reportlab.lib.utils import ImageReader
         try:
-            logo_path = os.path.join(UPLOAD_DIR, s.logo_filename)
             c.drawImage(
-                ImageReader(logo_path),
-                10 * mm,
-                height - 25 * mm,
-                30 * mm,
-                20 * mm,
+                _logo_reader(s.logo_filename),
+                PDF_MARGIN,
+                PDF_Y[25],
+                PDF_LOGO_W,
+                PDF_LOGO_H,
                 preserveAspectRatio=True,
                 mask="auto",
             )
@@ -818,106 +1005,93 @@ def order_pdf(order_id: int):
 
     # Cabecera empresa
     c.setFont("Helvetica-Bold", 14)
-    c.drawString(45 * mm, height - 15 * mm, s.empresa or "Servicio Técnico")
+    c.drawString(PDF_HEADER_X, PDF_Y[15], s.empresa or "Servicio Técnico")
     c.setFont("Helvetica", 9)
     sub = " · ".join([x for x in [s.direccion, s.telefono, s.email] if x])
     if sub:
-        c.drawString(45 * mm, height - 21 * mm, sub)
+        c.drawString(PDF_HEADER_X, PDF_Y[21], sub)
 
     # Datos principales de la orden
     c.setFont("Helvetica-Bold", 12)
-    c.drawString(10 * mm, height - 32 * mm, f"Orden #{o.id} — {o.estado_label()}")
+    c.drawString(PDF_MARGIN, PDF_Y[32], f"Orden #{o.id} — {o.estado_label()}")
     c.setFont("Helvetica", 10)
-    c.drawString(10 * mm, height - 38 * mm, f"Ingreso: {o.created_at.strftime('%d/%m/%Y %H:%M')}")
+    d = o.created_at
+    c.drawString(PDF_MARGIN, PDF_Y[38], f"Ingreso: {d.day:02d}/{d.month:02d}/{d.year} {d.hour:02d}:{d.minute:02d}")
 
     # Cliente
     c.setFont("Helvetica-Bold", 11)
-    c.drawString(10 * mm, height - 48 * mm, "Cliente")
+    c.drawString(PDF_MARGIN, PDF_Y[48], "Cliente")
     c.setFont("Helvetica", 10)
     c.drawString(
-        10 * mm,
-        height - 54 * mm,
+        PDF_MARGIN,
+        PDF_Y[54],
         f"{o.client.nombre}  {o.client.telefono or ''}  {o.client.email or ''}",
     )
 
     # Equipo
     c.setFont("Helvetica-Bold", 11)
-    c.drawString(10 * mm, height - 64 * mm, "Equipo")
+    c.drawString(PDF_MARGIN, PDF_Y[64], "Equipo")
     c.setFont("Helvetica", 10)
     c.drawString(
-        10 * mm,
-        height - 70 * mm,
+        PDF_MARGIN,
+        PDF_Y[70],
         f"{o.marca} {o.modelo} · IMEI: {o.imei or '—'} · Accesorios: {o.accesorios or '—'}",
     )
 
     # Problema reportado
     c.setFont("Helvetica-Bold", 11)
-    c.drawString(10 * mm, height - 82 * mm, "Problema reportado")
-    t1 = c.beginText(10 * mm, height - 88 * mm)
+    c.drawString(PDF_MARGIN, PDF_Y[82], "Problema reportado")
+    t1 = c.beginText(PDF_MARGIN, PDF_Y[88])
     t1.setFont("Helvetica", 10)
     t1.textLines(o.problema_reportado or "")
     c.drawText(t1)
 
     # Diagnóstico
     c.setFont("Helvetica-Bold", 11)
-    c.drawString(10 * mm, height - 102 * mm, "Diagnóstico")
-    t2 = c.beginText(10 * mm, height - 108 * mm)
+    c.drawString(PDF_MARGIN, PDF_Y[102], "Diagnóstico")
+    t2 = c.beginText(PDF_MARGIN, PDF_Y[108])
     t2.setFont("Helvetica", 10)
     t2.textLines(o.diagnostico or "—")
     c.drawText(t2)
 
     # Costos
     c.setFont("Helvetica-Bold", 11)
-    c.drawString(10 * mm, height - 120 * mm, "Costos")
+    c.drawString(PDF_MARGIN, PDF_Y[120], "Costos")
     c.setFont("Helvetica", 10)
-    costo = (
-        f"AR$ {o.costo_estimado:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-        if o.costo_estimado is not None
-        else "—"
-    )
-    senia = (
-        f"AR$ {o.senia:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-        if o.senia
-        else "—"
-    )
+    costo = ars(o.costo_estimado) if o.costo_estimado is not None else "—"
+    senia = ars(o.senia) if o.senia else "—"
     c.drawString(
-        10 * mm,
-        height - 126 * mm,
+        PDF_MARGIN,
+        PDF_Y[126],
         f"Costo estimado: {costo} · Seña: {senia}",
     )
 
     # QR + link público
-    from reportlab.lib.utils import ImageReader
-    c.drawString(width - 60 * mm, height - 84 * mm, "Seguimiento online:")
+    c.drawString(PDF_QR_X, PDF_Y[84], "Seguimiento online:")
     c.setFont("Helvetica", 8)
     c.drawString(
-        width - 60 * mm,
-        height - 88 * mm,
+        PDF_QR_X,
+        PDF_Y[88],
         public_url[:60] + ("..." if len(public_url) > 60 else ""),
     )
     c.drawImage(
         ImageReader(io.BytesIO(qr_png)),
-        width - 60 * mm,
-        height - 80 * mm,
-        40 * mm,
-        40 * mm,
+        PDF_QR_X,
+        PDF_Y[80],
+        PDF_QR_SIZE,
+        PDF_QR_SIZE,
         preserveAspectRatio=True,
         mask="auto",
     )
 
     # Condiciones / garantía en varias líneas
-    from textwrap import wrap
-
     if s.condiciones:
         c.setFont("Helvetica", 8)
-        texto = s.condiciones.replace("\r", "").strip()
-        lineas = wrap(texto, 110)  # ajustá el 110 si querés más/menos ancho
 
         text_obj = c.beginText()
-        text_obj.setTextOrigin(10 * mm, 10 * mm)  # margen inferior izquierdo
+        text_obj.setTextOrigin(PDF_MARGIN, PDF_MARGIN)  # margen inferior izquierdo
 
-        # Máximo de líneas visibles para no pisar el resto del contenido
-        for linea in lineas[:6]:
+        for linea in _wrap_condiciones(s.condiciones):
             text_obj.textLine(linea)
 
         c.drawText(text_obj)
@@ -930,27 +1104,65 @@ def order_pdf(order_id: int):
         mimetype="application/pdf",
         as_attachment=True,
         download_name=f"orden_{o.id}.pdf",
+        max_age=0,  # el PDF cambia con el estado de la orden
     )
 
+def _qr_static_url(token: str, public_url: str) -> str:
+    # El nombre incluye un hash de la URL: si la orden se abre desde otro host
+    # (localhost, IP de la LAN, dominio público) se genera su propio QR
+    url_hash = hashlib.sha1(public_url.encode()).hexdigest()[:8]
+    filename = f"{token}-{url_hash}.png"
+    path = os.path.join(QR_DIR, filename)
+    # Se genera una sola vez; después lo sirve el frontend/proxy como archivo estático.
+    # Solo se llama desde vistas con login: el host sale del request y no queremos que
+    # cualquiera pueda llenar static/qr/ mandando otro Host.
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(_qr_bytes_for_url(public_url))
+            os.replace(tmp_path, path)
+        except OSError:
+            # No dejar .tmp a medio escribir
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return url_for("static", filename=f"qr/{filename}")
+
 @app.get("/orders/<int:order_id>/qr.png")
 def order_qr_png(order_id: int):
-    o = RepairOrder.query.get_or_404(order_id)
+    # Ruta pública: responde desde la caché en memoria, sin escribir en disco
+    o = db.get_or_404(RepairOrder, order_id)
     public_url = url_for("order_public", token=o.token_publico, _external=True)
-    img = qrcode.make(public_url)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return send_file(buf, mimetype="image/png")
+    return send_file(io.BytesIO(_qr_bytes_for_url(public_url)), mimetype="image/png")
+
+def _public_etag(o: RepairOrder, s: Settings) -> str:
+    # Todo lo que muestra la página pública: si nada cambió, el navegador recibe un 304
+    key = (
+        o.id, o.updated_at, o.client.nombre, o.client.telefono, o.client.email,
+        s.empresa, s.direccion, s.telefono, s.email, s.logo_filename, s.condiciones,
+    )
+    return hashlib.sha1(repr(key).encode()).hexdigest()
 
 @app.get("/t/<token>")
 def order_public(token: str):
-    o = RepairOrder.query.filter_by(token_publico=token).first_or_404()
-    return render_template("public_order.html", order=o)
+    o = RepairOrder.query.options(joinedload(RepairOrder.client)).filter_by(token_publico=token).first_or_404()
+    etag = _public_etag(o, get_settings())
+    if request.if_none_match.contains_weak(etag):
+        # Comparación débil (RFC 9110): los proxies que comprimen marcan el ETag como W/"..."
+        resp = make_response("", 304)  # sin render del template
+    else:
+        resp = make_response(render_template("public_order.html", order=o))
+    resp.set_etag(etag)
+    # Los clientes suelen refrescar la página: 30 s en su navegador (privado, tiene datos personales)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = 30
+    return resp
 
 @app.get("/orders/<int:order_id>/ticket")
 @login_required
 @roles_required("admin", "tecnico", "cajero")
 
 def order_ticket(order_id: int):
-    order = RepairOrder.query.get_or_404(order_id)
+    order = db.get_or_404(RepairOrder, order_id)
     return render_template("ticket.html", order=order)
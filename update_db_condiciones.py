@@ -8,54 +8,116 @@ Uso:
            python update_db_condiciones.py
 """
 
+import logging
 import sqlite3
 import os
-import shutil
+import sys
+from contextlib import closing
 
 DB_FILENAME = "sat.db"
 BACKUP_FILENAME = "sat_backup_before_condiciones.db"
+# Marca de "ya aplicado": guarda el schema cookie de sat.db después de migrar
+SENTINEL_FILENAME = ".condiciones_applied"
 
+# Páginas copiadas por paso del backup (entre pasos otros procesos pueden usar la base)
+BACKUP_PAGES = 1000
 
-def main():
+log = logging.getLogger(__name__)
+
+
+def copiar_db(src, dst):
+    # Backup en línea de SQLite: copia consistente página por página aunque la app
+    # tenga la base abierta (o tenga un -wal pendiente). Copiar el archivo a mano no
+    # lo garantiza, y un hardlink no sirve porque SQLite modifica el archivo en el lugar.
+    tmp = dst + ".tmp"
+    with closing(sqlite3.connect(src)) as origen, closing(sqlite3.connect(tmp)) as destino:
+        origen.backup(destino, pages=BACKUP_PAGES)
+    # Recién con el backup completo aparece con su nombre final
+    os.replace(tmp, dst)
+
+
+def schema_cookie(path):
+    # Encabezado SQLite, offset 40: el "schema cookie" cambia con cada cambio de esquema
+    with open(path, "rb") as f:
+        return int.from_bytes(f.read(100)[40:44], "big")
+
+
+def ya_aplicada():
+    # Si el esquema no cambió desde la última corrida, no hay nada que hacer
+    try:
+        with open(SENTINEL_FILENAME) as f:
+            return f.read().strip() == str(schema_cookie(DB_FILENAME))
+    except FileNotFoundError:
+        return False
+
+
+def migrar():
     if not os.path.exists(DB_FILENAME):
-        print(f"No se encontró {DB_FILENAME} en esta carpeta.")
+        log.warning("No se encontró %s en esta carpeta.", DB_FILENAME)
+        return
+
+    if ya_aplicada():
+        log.info("La columna 'condiciones' ya fue agregada. No se hace nada.")
         return
 
     # Backup de seguridad
-    if not os.path.exists(BACKUP_FILENAME):
-        shutil.copy(DB_FILENAME, BACKUP_FILENAME)
-        print(f"Copia de seguridad creada: {BACKUP_FILENAME}")
+    if os.path.exists(BACKUP_FILENAME):
+        log.info("Ya existe un backup: %s", BACKUP_FILENAME)
     else:
-        print(f"Ya existe un backup: {BACKUP_FILENAME}")
+        copiar_db(DB_FILENAME, BACKUP_FILENAME)
+        log.info("Copia de seguridad creada: %s", BACKUP_FILENAME)
 
-    conn = sqlite3.connect(DB_FILENAME)
-    cur = conn.cursor()
+    # Autocommit: las transacciones las abrimos nosotros con BEGIN IMMEDIATE.
+    # closing() cierra la conexión; "with conn" hace commit al salir o rollback si hay error.
+    with closing(sqlite3.connect(DB_FILENAME, isolation_level=None)) as conn, conn:
+        # Todo en un solo executescript: SQLite prepara y ejecuta el lote entero de una vez.
+        # Los PRAGMA son ajustes solo para esta conexión (no cambian el archivo de la base).
+        # BEGIN IMMEDIATE toma el lock de escritura desde el principio para no chocar con la
+        # app (SQLITE_BUSY). SQLite no tiene ADD COLUMN IF NOT EXISTS: si ya existe, el ALTER
+        # falla con "duplicate column name" y lo tomamos como hecho (el script se corta ahí y
+        # la transacción vacía la cierra el "with conn").
+        try:
+            conn.executescript(
+                "PRAGMA synchronous=NORMAL;"
+                "PRAGMA busy_timeout=5000;"
+                "PRAGMA cache_size=-20000;"
+                "PRAGMA temp_store=MEMORY;"
+                "BEGIN IMMEDIATE;"
+                "ALTER TABLE settings ADD COLUMN condiciones TEXT;"
+                "COMMIT;"
+            )
+            agregada = True
+        except sqlite3.OperationalError as e:
+            if "duplicate column" not in str(e).lower():
+                raise
+            agregada = False
 
-    # Ver columnas actuales de 'settings'
-    cur.execute("PRAGMA table_info(settings)")
-    cols = cur.fetchall()
-    col_names = [c[1] for c in cols]
-    print("Columnas actuales en 'settings':", col_names)
+    # Leído después del commit, con el esquema ya actualizado
+    with open(SENTINEL_FILENAME, "w") as f:
+        f.write(str(schema_cookie(DB_FILENAME)))
 
-    # Si ya existe, no hacemos nada
-    if "condiciones" in col_names:
-        print("La columna 'condiciones' ya existe. No se hace nada.")
-        conn.close()
+    if not agregada:
+        log.info("La columna 'condiciones' ya existe. No se hace nada.")
         return
+    log.info("Columna 'condiciones' agregada a la tabla 'settings'.")
+    log.info("Listo. Ahora podés usar el campo 'condiciones' en tu modelo Settings.")
 
-    # Agregar la columna
-    print("Agregando columna 'condiciones' a la tabla 'settings'...")
-    cur.execute("ALTER TABLE settings ADD COLUMN condiciones TEXT")
-    conn.commit()
-
-    # Verificar
-    cur.execute("PRAGMA table_info(settings)")
-    cols_after = cur.fetchall()
-    col_names_after = [c[1] for c in cols_after]
-    print("Columnas después del cambio:", col_names_after)
 
-    conn.close()
-    print("Listo. Ahora podés usar el campo 'condiciones' en tu modelo Settings.")
+def main():
+    # Un valor desconocido (p. ej. un typo) no debe cortar la migración: se usa INFO
+    nivel = os.environ.get("PYTHONLOGLEVEL", "INFO").strip().upper()
+    if nivel.isdigit():
+        nivel = int(nivel)
+    elif not isinstance(logging.getLevelName(nivel), int):
+        nivel = "INFO"
+    # Logging configurado una sola vez. En CI, PYTHONLOGLEVEL=WARNING silencia los mensajes
+    # informativos (ni siquiera se formatean)
+    logging.basicConfig(
+        level=nivel,
+        format="%(message)s",
+        stream=sys.stdout,
+    )
+    migrar()
 
 
 if __name__ == "__main__":